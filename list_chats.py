@@ -16,15 +16,25 @@ Features:
 """
 
 import argparse
+import asyncio
 import json
 import os
 import sys
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, List, Tuple
 
 from telethon import TelegramClient
 from telethon.sessions import StringSession
-from telethon.utils import get_peer_id
+from telethon.tl.types import (
+    InputPeerChannel,
+    InputPeerChannelFromMessage,
+    InputPeerChat,
+    InputPeerUser,
+    InputPeerUserFromMessage,
+)
+from telethon.utils import get_input_peer, get_peer_id
+
+from tg_loop import install_event_loop
 
 
 # ---------- helpers ----------
@@ -52,26 +62,66 @@ def build_client() -> TelegramClient:
     return TelegramClient(str(session_base), api_id, api_hash)
 
 
+# Max concurrent get_input_entity calls (keeps clear of FloodWait)
+RESOLVE_CONCURRENCY = 10
+
+# Fields printed per InputPeer type (InputPeerSelf/Empty carry none)
+_IP_FIELDS: Dict[type, Tuple[str, ...]] = {
+    InputPeerUser: ("user_id", "access_hash"),
+    InputPeerChat: ("chat_id",),
+    InputPeerChannel: ("channel_id", "access_hash"),
+    InputPeerUserFromMessage: ("user_id",),
+    InputPeerChannelFromMessage: ("channel_id",),
+}
+
+
 def input_peer_to_dict(ip: Any) -> Dict[str, Any]:
     """Serialize InputPeer* structure into dict."""
     if ip is None:
         return {}
     data: Dict[str, Any] = {"type": ip.__class__.__name__}
-    for f in ("user_id", "chat_id", "channel_id"):
-        if hasattr(ip, f):
-            data[f] = getattr(ip, f)
-    if hasattr(ip, "access_hash"):
-        data["access_hash"] = getattr(ip, "access_hash")
+    for f in _IP_FIELDS.get(type(ip), ()):
+        data[f] = getattr(ip, f)
     return data
 
 
+async def resolve_input_peers(client: TelegramClient, entities: List[Any]) -> List[Any]:
+    """Resolve InputPeer for each entity (None where it can't be resolved).
+
+    Peers are built from the in-memory access_hash; the ones that need
+    Telegram are fetched concurrently, at most RESOLVE_CONCURRENCY at a time.
+    """
+    ips: List[Any] = [None] * len(entities)
+    missing: List[int] = []
+    for i, ent in enumerate(entities):
+        try:
+            ips[i] = get_input_peer(ent)
+        except TypeError:
+            missing.append(i)
+
+    sem = asyncio.Semaphore(RESOLVE_CONCURRENCY)
+
+    async def fetch(ent: Any) -> Any:
+        async with sem:
+            return await client.get_input_entity(ent)
+
+    # May fail for special/system entities
+    results = await asyncio.gather(
+        *(fetch(entities[i]) for i in missing), return_exceptions=True
+    )
+    for i, res in zip(missing, results):
+        ips[i] = None if isinstance(res, Exception) else res
+    return ips
+
+
 # ---------- main ----------
 
 
 async def list_chats(client: TelegramClient, as_json: bool) -> None:
     dialogs = await client.get_dialogs()
+    ips = await resolve_input_peers(client, [d.entity for d in dialogs])
 
-    for d in dialogs:
+    for d, ip in zip(dialogs, ips):
         ent = d.entity
         title = (
             getattr(ent, "title", None) or getattr(ent, "first_name", None) or "NoTitle"
@@ -80,12 +130,6 @@ async def list_chats(client: TelegramClient, as_json: bool) -> None:
         ent_type = ent.__class__.__name__
         peer = get_peer_id(ent)
 
-        # Resolve InputPeer (may fail for special/system entities)
-        try:
-            ip = await client.get_input_entity(ent)
-        except Exception:
-            ip = None
-
         record = {
             "title": title,
             "id": getattr(ent, "id", None),
@@ -141,6 +185,7 @@ def parse_args() -> argparse.Namespace:
 
 def main() -> None:
     args = parse_args()
+    install_event_loop()
     client = build_client()
     with client:
         client.loop.run_until_complete(list_chats(client, as_json=args.json))
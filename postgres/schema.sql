@@ -25,7 +25,9 @@ CREATE TABLE IF NOT EXISTS messages (
     created_at TIMESTAMPTZ DEFAULT NOW(),
     updated_at TIMESTAMPTZ DEFAULT NOW(),
     
-    -- Ensure unique messages per chat
+    -- Ensure unique messages per chat. The backing index also serves the
+    -- upsert conflict target and the scraper's "latest message_id per chat"
+    -- fallback (ORDER BY message_id DESC LIMIT 1) when scraper_state is empty.
     UNIQUE(chat_peer_id, message_id)
 );
 
@@ -0,0 +1,19 @@
+"""
+Optional build step: compile tg_message.py (the per-message hot path) with mypyc.
+
+    pip install mypy
+    python setup.py build_ext --inplace
+
+Without mypyc the plain Python module is used unchanged.
+"""
+
+from setuptools import setup
+
+try:
+    from mypyc.build import mypycify
+except ImportError:
+    ext_modules = []
+else:
+    ext_modules = mypycify(["tg_message.py"])
+
+setup(py_modules=["tg_message"], ext_modules=ext_modules)
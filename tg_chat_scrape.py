@@ -1,22 +1,33 @@
 #!/usr/bin/env python3
 
-from typing import Any, Callable
+from typing import Any, Awaitable, Callable, TypeVar
 import os
+import io
+import csv
 import sys
-import json
+import random
+import asyncio
 import time
+import functools
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
 from telethon import TelegramClient, events
+from telethon.errors import FloodWaitError, ServerError
 from telethon.events import NewMessage
 from telethon.tl.custom.message import Message
 from telethon.utils import get_peer_id
 from telethon.sessions import StringSession
 
+from tg_loop import install_event_loop
+from tg_message import message_to_dict
 
-import psycopg2
-from psycopg2.extras import Json
+
+import orjson
+from psycopg2.extras import Json, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 
 
 def get_required_env(name: str) -> str:
@@ -52,13 +63,87 @@ STATE_DIR = DATA_DIR / "state"
 STATE_DIR.mkdir(parents=True, exist_ok=True)
 
 
+# STDOUT mode: write JSON lines to the binary buffer, flush every N messages
+STDOUT_FLUSH_EVERY = 1000
+_stdout_write = sys.stdout.buffer.write
+_stdout_pending = 0
+
+# Tail mode persists state every N messages or T seconds, whichever comes first
+STATE_SAVE_EVERY = 50
+STATE_SAVE_INTERVAL = 5.0
+
+# Called before the DB connection is released on exit (e.g. final state save)
+_shutdown_hooks: list[Callable[[], None]] = []
+
+# Retries for flood waits and Telegram-side (5xx) errors
+RETRY_ATTEMPTS = 8
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+# Telegram returns at most 100 messages per messages.getHistory call
+PAGE_SIZE = 100
+
+# Pending DB rows: (chat_peer_id, message_id, date, data)
+# Small batches are upserted with execute_values (BATCH_SIZE rows per statement),
+# large backfill batches are streamed with COPY through a temp table.
+BATCH_SIZE = 500
+COPY_THRESHOLD = 10_000
+_msg_buffer: list[tuple[int, int, datetime, dict[str, Any]]] = []
+
+
+class OrJson(Json):
+    """psycopg2 Json adapter serializing with orjson"""
+
+    def dumps(self, obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+
+@functools.lru_cache(maxsize=32)
 def get_state_file(chat_id: int | str) -> Path:
     return STATE_DIR / str(chat_id)
 
 
-def get_db_connection(database_url: str | None) -> psycopg2.extensions.connection:
-    return psycopg2.connect(database_url)
+# Sized for a few concurrent chat workers sharing one process
+DB_POOL_MIN = 1
+DB_POOL_MAX = 4
+
+# Blocking psycopg2 calls made from coroutines run here, one at a time, so the
+# event loop keeps serving Telethon and writes on a connection never interleave
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
 
+def get_db_pool(database_url: str | None) -> ThreadedConnectionPool:
+    return ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, database_url)
+
+
+def get_db_connection(db_pool: ThreadedConnectionPool) -> Any:
+    db_conn = db_pool.getconn()
+    db_conn.set_session(isolation_level="READ COMMITTED", autocommit=False)
+    prepare_statements(db_conn)
+    return db_conn
+
+
+def prepare_statements(db_conn: Any) -> None:
+    """Prepare the single-message upsert used by tail mode (once per session)"""
+    with db_conn.cursor() as cur:
+        # Pooled connections may come back with the statement already prepared
+        cur.execute("SELECT 1 FROM pg_prepared_statements WHERE name = 'insert_msg'")
+        if cur.fetchone() is not None:
+            db_conn.commit()
+            return
+        cur.execute(
+            """
+            PREPARE insert_msg (bigint, integer, timestamptz, jsonb) AS
+            INSERT INTO messages (chat_peer_id, message_id, date, data)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (chat_peer_id, message_id)
+            DO UPDATE SET data = EXCLUDED.data, updated_at = NOW()
+        """
+        )
+    db_conn.commit()
+
+
+install_event_loop()
 
 SESSION_BASENAME = DATA_DIR / "session"
 SESSION_FILE = Path(str(SESSION_BASENAME) + ".session")
@@ -93,6 +178,17 @@ def read_last_id_from_db(db_conn: Any, peer_id: int) -> int:
                 (peer_id,),
             )
             result = cur.fetchone()
+            if result is None:
+                # No state row (lost or never saved): resume from stored messages.
+                # Served by the UNIQUE (chat_peer_id, message_id) index.
+                cur.execute(
+                    """
+                    SELECT message_id FROM messages WHERE chat_peer_id = %s
+                    ORDER BY message_id DESC LIMIT 1
+                """,
+                    (peer_id,),
+                )
+                result = cur.fetchone()
             return int(result[0]) if result else 0
     except Exception as e:
         print(f"Error reading last_id from DB: {e}", file=sys.stderr)
@@ -115,23 +211,40 @@ def save_last_id_to_file(state_file: Path, msg_id: int) -> None:
         print(f"Error saving state file: {e}", file=sys.stderr)
 
 
+def upsert_last_id(cur: Any, peer_id: int, msg_id: int) -> None:
+    cur.execute(
+        """
+        INSERT INTO scraper_state (chat_peer_id, last_message_id, last_run_at)
+        VALUES (%s, %s, NOW())
+        ON CONFLICT (chat_peer_id)
+        DO UPDATE SET last_message_id = %s, last_run_at = NOW()
+    """,
+        (peer_id, msg_id, msg_id),
+    )
+
+
 def save_last_id_to_db(db_conn: Any, peer_id: int, msg_id: int) -> None:
     try:
         with db_conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO scraper_state (chat_peer_id, last_message_id, last_run_at)
-                VALUES (%s, %s, NOW())
-                ON CONFLICT (chat_peer_id)
-                DO UPDATE SET last_message_id = %s, last_run_at = NOW()
-            """,
-                (peer_id, msg_id, msg_id),
-            )
+            upsert_last_id(cur, peer_id, msg_id)
             db_conn.commit()
     except Exception as e:
+        db_conn.rollback()
         print(f"Error saving last_id to DB: {e}", file=sys.stderr)
 
 
+def commit_backfill(db_conn: Any, peer_id: int, max_id: int | None) -> None:
+    """Commit backfilled messages together with the new state, raising on failure"""
+    try:
+        if max_id is not None:
+            with db_conn.cursor() as cur:
+                upsert_last_id(cur, peer_id, max_id)
+        db_conn.commit()
+    except Exception:
+        db_conn.rollback()
+        raise
+
+
 def save_last_id_conn(db_conn: Any | None, peer_id: int, msg_id: int) -> None:
     if db_conn is not None:
         save_last_id_to_db(db_conn, peer_id, msg_id)
@@ -139,112 +252,207 @@ def save_last_id_conn(db_conn: Any | None, peer_id: int, msg_id: int) -> None:
         save_last_id_to_file(get_state_file(peer_id), msg_id)
 
 
-def message_to_dict(peer_id: int, msg: Message) -> dict[str, Any]:
-    """Convert Telegram message to dict/JSON"""
-    return {
-        "id": msg.id,
-        "chat_id": msg.chat_id,
-        "peer_id": peer_id,
-        "date": msg.date.isoformat() if msg.date else None,
-        "text": msg.text,
-        "sender_id": msg.sender_id,
-        # Sender info
-        "sender": {
-            "id": msg.sender.id if msg.sender else None,
-            "username": msg.sender.username if msg.sender else None,
-            "first_name": msg.sender.first_name if msg.sender else None,
-            "last_name": msg.sender.last_name if msg.sender else None,
-            "is_bot": getattr(msg.sender, "bot", False) if msg.sender else False,
-        }
-        if msg.sender
-        else None,
-        # Message metadata
-        "edit_date": msg.edit_date.isoformat() if msg.edit_date else None,
-        "out": msg.out,
-        "mentioned": msg.mentioned,
-        "silent": msg.silent,
-        "post": msg.post,
-        "views": msg.views,
-        "forwards": msg.forwards,
-        "pinned": msg.pinned,
-        # Reply and forward
-        "reply_to_msg_id": msg.reply_to_msg_id,
-        "forward": (
-            {
-                "from_id": get_peer_id(msg.forward.from_id)
-                if msg.forward.from_id
-                else None,
-                "from_name": msg.forward.from_name,
-                "date": msg.forward.date.isoformat() if msg.forward.date else None,
-            }
-            if msg.forward
-            else None
-        ),
-        # Media
-        "has_media": msg.media is not None,
-        "media_type": msg.media.__class__.__name__ if msg.media else None,
-        # Reactions
-        "reactions": [
-            {
-                "emoji": getattr(r.reaction, "emoticon", None),
-                "custom_emoji_id": getattr(r.reaction, "document_id", None),
-                "count": r.count,
-                "i_reacted": hasattr(r, "chosen_order"),
-                "my_reaction_order": getattr(r, "chosen_order", None),
-            }
-            for r in (getattr(msg.reactions, "results", []) if msg.reactions else [])
-        ]
-        if msg.reactions
-        else [],
-        # Entities (links, mentions, etc)
-        "entities": [
-            {
-                "type": e.__class__.__name__,
-                "offset": e.offset,
-                "length": e.length,
-                "url": getattr(e, "url", None),
-            }
-            for e in (msg.entities or [])
-        ],
-    }
+T = TypeVar("T")
+
+
+async def run_db(func: Callable[..., T], *args: Any) -> T:
+    """Run blocking DB work on DB_EXECUTOR"""
+    return await asyncio.get_running_loop().run_in_executor(DB_EXECUTOR, func, *args)
+
+
+async def with_backoff(coro_factory: Callable[[], Awaitable[T]]) -> T:
+    """Await coro_factory(), retrying on FloodWaitError and server errors"""
+    for attempt in range(1, RETRY_ATTEMPTS + 1):
+        try:
+            return await coro_factory()
+        except (FloodWaitError, ServerError) as e:
+            if attempt == RETRY_ATTEMPTS:
+                raise
+            if isinstance(e, FloodWaitError):
+                delay = e.seconds + random.uniform(0, 1)
+            else:
+                delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+                delay += random.uniform(0, 1)
+            print(
+                f"[retry] {e.__class__.__name__}: {e}. Sleeping {delay:.1f}s",
+                file=sys.stderr,
+            )
+        await asyncio.sleep(delay)
+
+    raise AssertionError("unreachable")
 
 
 def output_msg_to_stdout(msg_dict: dict[str, Any]) -> None:
-    print(json.dumps(msg_dict, ensure_ascii=False), flush=True)
+    global _stdout_pending
+    _stdout_write(orjson.dumps(msg_dict))
+    _stdout_write(b"\n")
+    _stdout_pending += 1
+    if _stdout_pending >= STDOUT_FLUSH_EVERY:
+        flush_stdout()
 
 
-def output_msg_to_db_reuse(
+def flush_stdout() -> None:
+    global _stdout_pending
+    sys.stdout.buffer.flush()
+    _stdout_pending = 0
+
+
+async def output_msg_to_db_reuse(
     db_conn: Any, peer_id: int, msg_dict: dict[str, Any], msg: Any
+) -> None:
+    _msg_buffer.append((peer_id, msg.id, msg.date, msg_dict))
+    if len(_msg_buffer) >= COPY_THRESHOLD:
+        await flush_msg_buffer(db_conn)
+
+
+def insert_msg_rows(cur: Any, rows: list[tuple[Any, ...]]) -> None:
+    execute_values(
+        cur,
+        """
+        INSERT INTO messages (chat_peer_id, message_id, date, data)
+        VALUES %s
+        ON CONFLICT (chat_peer_id, message_id)
+        DO UPDATE SET data = EXCLUDED.data, updated_at = NOW()
+    """,
+        [(peer_id, msg_id, date, OrJson(data)) for peer_id, msg_id, date, data in rows],
+        page_size=BATCH_SIZE,
+    )
+
+
+def copy_msg_rows(cur: Any, rows: list[tuple[Any, ...]]) -> None:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for peer_id, msg_id, date, data in rows:
+        writer.writerow(
+            (peer_id, msg_id, date.isoformat(), orjson.dumps(data).decode())
+        )
+    buffer.seek(0)
+
+    # COPY can't upsert, so load into a temp table and merge from there
+    cur.execute(
+        """
+        CREATE TEMP TABLE IF NOT EXISTS messages_import (
+            chat_peer_id BIGINT,
+            message_id INTEGER,
+            date TIMESTAMPTZ,
+            data JSONB
+        )
+    """
+    )
+    cur.copy_expert(
+        """
+        COPY messages_import (chat_peer_id, message_id, date, data)
+        FROM STDIN WITH (FORMAT csv, QUOTE '"')
+    """,
+        buffer,
+    )
+    cur.execute(
+        """
+        INSERT INTO messages (chat_peer_id, message_id, date, data)
+        SELECT chat_peer_id, message_id, date, data FROM messages_import
+        ON CONFLICT (chat_peer_id, message_id)
+        DO UPDATE SET data = EXCLUDED.data, updated_at = NOW()
+    """
+    )
+    cur.execute("TRUNCATE messages_import")
+
+
+async def flush_msg_buffer(db_conn: Any) -> None:
+    """Write buffered messages to the current transaction (caller commits)"""
+    if not _msg_buffer:
+        return
+
+    rows = _msg_buffer[:]
+    _msg_buffer.clear()
+    await run_db(write_msg_rows, db_conn, rows)
+
+
+def write_msg_rows(
+    db_conn: Any, rows: list[tuple[Any, ...]], commit: bool = False
 ) -> None:
     try:
         with db_conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO messages (chat_peer_id, message_id, date, data)
-                VALUES (%s, %s, %s, %s)
-                ON CONFLICT (chat_peer_id, message_id)
-                DO UPDATE SET data = EXCLUDED.data, updated_at = NOW()
-            """,
-                (peer_id, msg.id, msg.date, Json(msg_dict)),
-            )
+            if len(rows) == 1:
+                peer_id, msg_id, date, data = rows[0]
+                cur.execute(
+                    "EXECUTE insert_msg (%s, %s, %s, %s)",
+                    (peer_id, msg_id, date, OrJson(data)),
+                )
+            elif len(rows) >= COPY_THRESHOLD:
+                copy_msg_rows(cur, rows)
+            else:
+                insert_msg_rows(cur, rows)
+        if commit:
             db_conn.commit()
+    except Exception:
+        db_conn.rollback()
+        raise
 
-        print(
-            f"[DB] Saved message {msg.id} for chat {peer_id}",
-            file=sys.stderr,
-            flush=True,
-        )
-    except Exception as e:
-        print(f"Error saving message {msg.id}: {e}", file=sys.stderr)
+    print(
+        f"[DB] Saved {len(rows)} messages for chat {rows[0][0]}",
+        file=sys.stderr,
+        flush=True,
+    )
+
+
+async def save_msg_now(db_conn: Any, peer_id: int, message: Message) -> None:
+    """Write and commit one message in a single DB job, bypassing the buffer.
 
+    Tail-mode handlers run concurrently; a write and its commit in separate
+    jobs (or a shared buffer) would let one message's rollback drop another.
+    """
+    row = (peer_id, message.id, message.date, message_to_dict(peer_id, message))
+    await run_db(write_msg_rows, db_conn, [row], True)
 
-def output_msg(db_conn: Any | None, peer_id: int, message: Message) -> None:
+
+async def output_msg(db_conn: Any | None, peer_id: int, message: Message) -> None:
     msg_dict = message_to_dict(peer_id, message)
 
     if db_conn is None:
         output_msg_to_stdout(msg_dict)
     else:
-        output_msg_to_db_reuse(db_conn, peer_id, msg_dict, message)
+        await output_msg_to_db_reuse(db_conn, peer_id, msg_dict, message)
+
+
+async def fetch_pages(
+    client: TelegramClient,
+    chat_id: int | str,
+    last_id: int,
+    since: Any,
+    queue: "asyncio.Queue[list[Message] | None]",
+) -> None:
+    """Push history pages (oldest first) into queue, None marks the end"""
+    cursor = last_id
+    offset_date = since
+    # No end marker when cancelled: the consumer is gone and the queue may be
+    # full, so the put would block forever
+    try:
+        while True:
+            page = await with_backoff(
+                lambda: client.get_messages(
+                    chat_id,
+                    limit=PAGE_SIZE,
+                    min_id=cursor,
+                    offset_date=offset_date,
+                    reverse=True,
+                    # Telethon's default for limit <= 3000, kept explicit so a
+                    # larger PAGE_SIZE wouldn't add sleeps between requests
+                    wait_time=0,
+                )
+            )
+            if page:
+                await queue.put(page)
+            if len(page) < PAGE_SIZE:
+                break
+            # Only the first page needs the date bound, then min_id takes over
+            cursor = page[-1].id
+            offset_date = None
+    except Exception:
+        # Unblock the consumer, which re-raises this by awaiting the task
+        await queue.put(None)
+        raise
+
+    await queue.put(None)
 
 
 async def dump_messages(
@@ -252,23 +460,40 @@ async def dump_messages(
     chat_id: int | str,
     last_id: int,
     since: Any,
-    callback: Callable[[Message], None] | None = None,
+    callback: Callable[[Message], Awaitable[None]] | None = None,
 ) -> tuple[int, int]:
     """Fetch messages since last_id or lookback period"""
 
+    # Nothing to deliver and no bound: don't walk the whole chat history
+    if callback is None and last_id == 0 and since is None:
+        return last_id, 0
+
     max_id: int = last_id
     count: int = 0
-    messages = client.iter_messages(
-        chat_id, min_id=last_id, offset_date=since, reverse=True
+
+    # Prefetch the next page while the current one is being processed
+    queue: asyncio.Queue[list[Message] | None] = asyncio.Queue(maxsize=2)
+    producer = asyncio.ensure_future(
+        fetch_pages(client, chat_id, last_id, since, queue)
     )
 
-    async for msg in messages:
-        if callback is not None:
-            callback(msg)
+    try:
+        while (page := await queue.get()) is not None:
+            for msg in page:
+                if callback is not None:
+                    await callback(msg)
+
+                if msg.id is not None:
+                    max_id = max(max_id, msg.id)
+                    count += 1
+    except BaseException:
+        producer.cancel()
+        with contextlib.suppress(BaseException):
+            await producer
+        raise
 
-        if msg.id is not None:
-            max_id = max(max_id, msg.id)
-            count += 1
+    # Re-raise fetch errors instead of treating them as end of history
+    await producer
 
     return max_id, count
 
@@ -277,14 +502,14 @@ async def main(client: TelegramClient, db_conn: Any, chat_id: int | str) -> None
     await client.start()
 
     # Get chat info
-    chat_entity = await client.get_entity(chat_id)
+    chat_entity = await with_backoff(lambda: client.get_entity(chat_id))
     peer_id = get_peer_id(chat_entity)
     title = getattr(chat_entity, "title", chat_id)
     mode = "DATABASE" if db_conn else "STDOUT"
 
     print(f"Scraping: {title} [{peer_id} | {chat_id}]", file=sys.stderr)
 
-    # Fetch history
+    # Fetch history (in DB mode one transaction, committed together with the state)
     last_id = read_last_id(db_conn, peer_id, "--reset" in sys.argv)
     since = datetime.now(timezone.utc) - timedelta(hours=LOOKBACK_HOURS)
 
@@ -294,8 +519,14 @@ async def main(client: TelegramClient, db_conn: Any, chat_id: int | str) -> None
         client, chat_id, last_id, since, lambda msg: output_msg(db_conn, peer_id, msg)
     )
 
-    if max_id > last_id:
-        save_last_id_conn(db_conn, peer_id, max_id)
+    new_last_id = max_id if max_id > last_id else None
+    if db_conn is not None:
+        await flush_msg_buffer(db_conn)
+        await run_db(commit_backfill, db_conn, peer_id, new_last_id)
+    else:
+        flush_stdout()
+        if new_last_id is not None:
+            save_last_id_to_file(get_state_file(peer_id), new_last_id)
 
     print(f"[{mode}] Processed {count} messages. Last ID: {max_id}", file=sys.stderr)
 
@@ -310,31 +541,53 @@ async def main(client: TelegramClient, db_conn: Any, chat_id: int | str) -> None
     )
 
     last_printed_id = [max_id]
+    last_saved = [max_id, time.monotonic()]
+
+    def save_state(msg_id: int) -> None:
+        save_last_id_conn(db_conn, peer_id, msg_id)
+        last_saved[:] = [msg_id, time.monotonic()]
+
+    def save_final_state() -> None:
+        if last_printed_id[0] > last_saved[0]:
+            print(f"\nSaving final state: {last_printed_id[0]}", file=sys.stderr)
+            save_state(last_printed_id[0])
+
+    _shutdown_hooks.append(save_final_state)
 
     @client.on(events.NewMessage(chats=chat_id))
     async def handler(event: NewMessage.Event) -> None:
         msg = event.message
         if msg.id > last_printed_id[0]:
-            output_msg(db_conn, peer_id, msg)
-            save_last_id_conn(db_conn, peer_id, msg.id)
+            if db_conn is None:
+                await output_msg(db_conn, peer_id, msg)
+                flush_stdout()
+            else:
+                try:
+                    await save_msg_now(db_conn, peer_id, msg)
+                except Exception as e:
+                    print(f"Error saving message {msg.id}: {e}", file=sys.stderr)
             last_printed_id[0] = msg.id
 
-    try:
-        await client.run_until_disconnected()
-    except KeyboardInterrupt:
-        if last_printed_id[0] > max_id:
-            print(f"\nSaving final state: {last_printed_id[0]}", file=sys.stderr)
-            save_last_id_conn(db_conn, peer_id, last_printed_id[0])
-        raise
+            # State only has to be roughly current: after a crash at most the
+            # last few messages are fetched again (and upserted in DB mode)
+            if (
+                msg.id - last_saved[0] >= STATE_SAVE_EVERY
+                or time.monotonic() - last_saved[1] >= STATE_SAVE_INTERVAL
+            ):
+                await run_db(save_state, msg.id)
+
+    await client.run_until_disconnected()
 
 
 # Main execution
 start_time = time.monotonic()
+db_pool = None
 db_conn = None
 
 try:
     if USE_DATABASE:
-        db_conn = get_db_connection(DATABASE_URL)
+        db_pool = get_db_pool(DATABASE_URL)
+        db_conn = get_db_connection(db_pool)
 
     TELEGRAM_CLIENT.loop.run_until_complete(main(TELEGRAM_CLIENT, db_conn, CHAT_ID))
 
@@ -349,10 +602,21 @@ except Exception as e:
     sys.exit(1)
 
 finally:
+    # Let in-flight DB writes finish before the final state save and cleanup
+    DB_EXECUTOR.shutdown(wait=True)
+
+    for hook in _shutdown_hooks:
+        try:
+            hook()
+        except Exception as e:
+            print(f"[exit] Error in shutdown hook: {e}", file=sys.stderr)
+
     # Cleanup database connection
-    if db_conn:
+    if db_pool:
         try:
-            db_conn.close()
+            if db_conn:
+                db_pool.putconn(db_conn)
+            db_pool.closeall()
             print("[db] Connection closed", file=sys.stderr)
         except Exception as e:
             print(f"[db] Error closing connection: {e}", file=sys.stderr)
@@ -0,0 +1,23 @@
+"""
+tg_loop.py — event loop setup shared by the scraper scripts.
+"""
+
+import asyncio
+import sys
+
+
+def install_event_loop() -> asyncio.AbstractEventLoop:
+    """Create the event loop (uvloop where available) and make it current.
+
+    Call before building TelegramClient, which binds to the current loop.
+    The loop is set explicitly because uvloop's policy (>=0.22) no longer
+    creates one on get_event_loop().
+    """
+    if sys.platform != "win32":
+        import uvloop
+
+        loop = uvloop.new_event_loop()
+    else:
+        loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
@@ -0,0 +1,95 @@
+"""
+tg_message.py — convert Telethon messages into plain dicts.
+
+Kept free of side effects and fully annotated so it can be compiled with
+mypyc (see setup.py); the pure-Python module is used when it is not.
+"""
+
+from typing import Any
+
+from telethon.tl.custom.message import Message
+from telethon.utils import get_peer_id
+
+
+def strip_nul(value: str | None) -> str | None:
+    """Drop NUL characters: Postgres rejects them in text and jsonb"""
+    return value.replace("\x00", "") if value else value
+
+
+def sender_to_dict(sender: Any) -> dict[str, Any]:
+    """Convert message sender to dict"""
+    # Channels have no first/last name or bot flag
+    return {
+        "id": sender.id,
+        "username": sender.username,
+        "first_name": strip_nul(getattr(sender, "first_name", None)),
+        "last_name": strip_nul(getattr(sender, "last_name", None)),
+        "is_bot": getattr(sender, "bot", False),
+    }
+
+
+def message_to_dict(peer_id: int, msg: Message) -> dict[str, Any]:
+    """Convert Telegram message to dict/JSON"""
+    sender = msg.sender
+    fwd = msg.forward
+    reacts = msg.reactions
+    media = msg.media
+
+    return {
+        "id": msg.id,
+        "chat_id": msg.chat_id,
+        "peer_id": peer_id,
+        "date": msg.date,
+        "text": strip_nul(msg.text),
+        "sender_id": msg.sender_id,
+        # Sender info
+        "sender": sender_to_dict(sender) if sender else None,
+        # Message metadata
+        "edit_date": msg.edit_date,
+        "out": msg.out,
+        "mentioned": msg.mentioned,
+        "silent": msg.silent,
+        "post": msg.post,
+        "views": msg.views,
+        "forwards": msg.forwards,
+        "pinned": msg.pinned,
+        # Reply and forward
+        "reply_to_msg_id": msg.reply_to_msg_id,
+        "forward": (
+            {
+                "from_id": get_peer_id(fwd.from_id) if fwd.from_id else None,
+                "from_name": strip_nul(fwd.from_name),
+                "date": fwd.date,
+            }
+            if fwd
+            else None
+        ),
+        # Media
+        "has_media": media is not None,
+        "media_type": media.__class__.__name__ if media else None,
+        # Reactions
+        "reactions": [
+            {
+                "emoji": getattr(r.reaction, "emoticon", None),
+                "custom_emoji_id": getattr(r.reaction, "document_id", None),
+                "count": r.count,
+                "i_reacted": r.chosen_order is not None,
+                "my_reaction_order": r.chosen_order,
+            }
+            for r in reacts.results
+        ]
+        if reacts and reacts.results
+        else [],
+        # Entities (links, mentions, etc)
+        "entities": [
+            {
+                "type": e.__class__.__name__,
+                "offset": e.offset,
+                "length": e.length,
+                "url": strip_nul(getattr(e, "url", None)),
+            }
+            for e in msg.entities
+        ]
+        if msg.entities
+        else [],
+    }